@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+# Benchmarks get-springer-books.py against a local stand-in for
+# link.springer.com, serving synthetic books, so that the effect of a
+# change can be measured without hitting the real site.
+
+import argparse
+import BaseHTTPServer
+import csv
+import hashlib
+import imp
+import os
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+
+script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'get-springer-books.py')
+gsb = imp.load_source('get_springer_books', script_path)
+
+class Dataset(object):
+    """Synthetic books: whole-PDF ones, and chapter-only ones every
+    chapter_every books.
+
+    PDF contents are generated from the DOI on the fly, so only their
+    sizes and MD5s are kept in memory.
+    """
+
+    def __init__(self, book_count, chapter_every, chapter_count, pdf_size, chapter_size, page_size, denied_every):
+        self.page_size = page_size
+        self.books = []
+        self.pdfs = {}
+        self.chapters = {}
+        self.denied = set()
+        for i in xrange(0, book_count):
+            doi = '10.1007/978-3-540-%05d-%d' % (i, i % 10)
+            self.books.append({
+                'Item Title': 'Synthetic Book %d' % i,
+                'Publication Year': str(1970 + i % 50),
+                'Authors': 'Jane DoeJohn Smith',
+                'Item DOI': doi,
+            })
+            if chapter_every and i % chapter_every == chapter_every - 1:
+                chapter_dois = []
+                for j in xrange(1, chapter_count + 1):
+                    chapter_doi = '%s_%d' % (doi, j)
+                    self.add_pdf(chapter_doi, chapter_size)
+                    chapter_dois.append(chapter_doi)
+                    if denied_every and j % denied_every == 0:
+                        self.denied.add(chapter_doi)
+                self.chapters[doi] = chapter_dois
+            else:
+                self.add_pdf(doi, pdf_size)
+
+    def add_pdf(self, doi, size):
+        md5 = hashlib.md5()
+        for chunk in self.generate(doi, size, 0):
+            md5.update(chunk)
+        self.pdfs[doi] = (size, md5.hexdigest())
+
+    def generate(self, doi, size, start):
+        block = hashlib.sha1(doi).digest() * 4096
+        offset = start
+        while offset < size:
+            i = offset % len(block)
+            chunk = block[i:i + min(len(block) - i, size - offset)]
+            yield chunk
+            offset += len(chunk)
+
+    def write_csv(self, path, base_url):
+        with open(path, 'wb') as f:
+            writer = csv.DictWriter(f, ['Item Title', 'Publication Year', 'Authors', 'Item DOI', 'URL'])
+            writer.writeheader()
+            for book in self.books:
+                row = dict(book, URL='%s/book/%s' % (base_url, urllib.quote(book['Item DOI'], safe='')))
+                writer.writerow(row)
+
+    def render_landing_page(self, doi):
+        items = []
+        for (i, chapter_doi) in enumerate(self.chapters.get(doi, []), 1):
+            items.append('<li class="toc-item"><h3>Chapter %d</h3><a href="/chapter/%s">Look inside</a> <a href="/content/pdf/%s.pdf" title="Chapter %d of\n  %s" doi="%s">Download PDF</a></li>' % (i, chapter_doi, urllib.quote(chapter_doi, safe='/'), i, gsb.get_doi_suffix(doi), chapter_doi))
+        # Pad out to the size of a real landing page.
+        filler = '<p>%s</p>' % ('Lorem ipsum dolor sit amet. ' * 40)
+        filler_count = max(0, self.page_size / len(filler))
+        return '<html><head><meta charset="utf-8"><title>%s</title></head><body>%s<ol class="content-type-list">%s</ol></body></html>' % (doi, filler * filler_count, ''.join(items))
+
+class Counters(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+
+    def add(self, requests, bytes):
+        with self.lock:
+            self.requests += requests
+            self.bytes += bytes
+
+    def snapshot(self):
+        with self.lock:
+            return (self.requests, self.bytes)
+
+class SpringerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the endpoints get-springer-books.py uses:
+
+    - /content/pdf/<doi>.pdf, with Content-Length, an ETag of the form
+      "<md5>:<n>" and Range support, 404 for chapter-only books, and a
+      redirect to ?no-access=true for denied chapters,
+    - /book/<escaped doi>, a landing page with li.toc-item chapter links.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def do_GET(self):
+        self.respond(True)
+
+    def respond(self, send_body):
+        dataset = self.server.dataset
+        url = urlparse.urlparse(self.path)
+        path = urllib.unquote(url.path)
+        sent = 0
+        if path.startswith('/content/pdf/') and path.endswith('.pdf') and 'no-access=true' not in url.query:
+            doi = path[len('/content/pdf/'):-len('.pdf')]
+            if doi in dataset.denied:
+                self.send_empty(302, {'Location': '%s?no-access=true' % self.path})
+            elif doi in dataset.pdfs:
+                sent = self.send_pdf(doi, send_body)
+            else:
+                self.send_empty(404)
+        elif path.startswith('/book/'):
+            body = dataset.render_landing_page(path[len('/book/'):])
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+                sent = len(body)
+        else:
+            self.send_empty(404)
+        self.server.counters.add(1, sent)
+
+    def send_empty(self, status, headers={}):
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_pdf(self, doi, send_body):
+        (size, md5) = self.server.dataset.pdfs[doi]
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes=') and self.headers.get('If-Range', '"%s:1"' % md5) == '"%s:1"' % md5:
+            start = min(int(range_header[len('bytes='):].split('-')[0]), size)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"%s:1"' % md5)
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+        if not send_body:
+            return 0
+        for chunk in self.server.dataset.generate(doi, size, start):
+            self.wfile.write(chunk)
+        return size - start
+
+class SpringerServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, dataset):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), SpringerHandler)
+        self.dataset = dataset
+        self.counters = Counters()
+
+def run_script(workdir, script_args):
+    # Run main() in-process, so its metrics can be read afterwards,
+    # with the output thrown away.
+    old_argv = sys.argv
+    old_stdout = sys.stdout
+    old_cwd = os.getcwd()
+    sys.argv = [script_path] + script_args
+    sys.stdout = open(os.devnull, 'w')
+    os.chdir(workdir)
+    try:
+        gsb.main()
+    finally:
+        os.chdir(old_cwd)
+        sys.stdout = old_stdout
+        sys.argv = old_argv
+
+def rename_to_isbns(workdir):
+    # Undo the naming from a download, so --rename has work to do.
+    os.remove(os.path.join(workdir, '.get-springer-books-manifest.jsonl'))
+    for name in os.listdir(workdir):
+        tokens = gsb.get_filename_tokens(name)
+        if name.endswith('.pdf') and tokens:
+            os.rename(os.path.join(workdir, name), os.path.join(workdir, tokens[-1] + '.pdf'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark get-springer-books.py against a local server.')
+    parser.add_argument('--books', help='number of books in the synthetic csv', type=int, default=200)
+    parser.add_argument('--chapter-every', help='make every nth book chapter-only (0 for none)', type=int, default=5)
+    parser.add_argument('--chapters', help='number of chapters in chapter-only books', type=int, default=10)
+    parser.add_argument('--pdf-kb', help='size of whole-book PDFs in KB', type=int, default=1024)
+    parser.add_argument('--chapter-kb', help='size of chapter PDFs in KB', type=int, default=64)
+    parser.add_argument('--page-kb', help='size of book landing pages in KB', type=int, default=100)
+    parser.add_argument('--denied-every', help="deny access to every nth chapter (0 for none); like the real site, this aborts the run", type=int, default=0)
+    parser.add_argument('--scenarios', help='comma-separated scenarios to run, in order',
+                        default='download,manifest,redownload,list,rename')
+    parser.add_argument('--keep', help="don't delete the working directory at the end", action='store_true')
+    parser.add_argument('script_args', nargs=argparse.REMAINDER,
+                        help='extra arguments for get-springer-books.py (after --), e.g. -- --jobs 8')
+    args = parser.parse_args()
+
+    script_args = [arg for arg in args.script_args if arg != '--']
+
+    # Go straight to the local server.
+    for name in ('http_proxy', 'HTTP_PROXY', 'https_proxy', 'HTTPS_PROXY'):
+        os.environ.pop(name, None)
+
+    dataset = Dataset(args.books, args.chapter_every, args.chapters, args.pdf_kb * 1024, args.chapter_kb * 1024, args.page_kb * 1024, args.denied_every)
+    server = SpringerServer(dataset)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base_url = 'http://127.0.0.1:%d' % server.server_address[1]
+    gsb.springer_url = base_url
+
+    tmpdir = tempfile.mkdtemp(prefix='bench-get-springer-books-')
+    csv_path = os.path.join(tmpdir, 'SearchResults.csv')
+    dataset.write_csv(csv_path, base_url)
+    workdir = os.path.join(tmpdir, 'library')
+    os.mkdir(workdir)
+
+    print "%d books (%d chapter-only), %d PDFs, %.1f MB total" % (len(dataset.books), len(dataset.chapters), len(dataset.pdfs), sum(size for (size, md5) in dataset.pdfs.values()) / 1e6)
+    print "%-12s %9s %9s %9s %10s %12s %12s" % ('scenario', 'seconds', 'books/s', 'MB/s', 'reqs/book', 'parse (s)', 'compare (s)')
+    try:
+        for scenario in args.scenarios.split(','):
+            crawl_cache = os.path.join(tmpdir, 'crawl-cache')
+            if scenario in ('download', 'list'):
+                # Start from a cold crawl cache.
+                for name in os.listdir(tmpdir):
+                    if name.startswith('crawl-cache'):
+                        os.remove(os.path.join(tmpdir, name))
+            if scenario == 'download':
+                extra_args = []
+            elif scenario == 'manifest':
+                # Everything was verified by the download, so this only
+                # checks the manifest.
+                extra_args = ['--check-md5']
+            elif scenario == 'redownload':
+                # Without the manifest, every file is checked against
+                # its HEAD response and hashed.
+                extra_args = ['--check-md5', '--manifest', '']
+            elif scenario == 'list':
+                extra_args = ['--list', '--manifest', '']
+            elif scenario == 'rename':
+                rename_to_isbns(workdir)
+                extra_args = ['--rename']
+            else:
+                raise Exception("unknown scenario %s" % scenario)
+
+            (requests_before, bytes_before) = server.counters.snapshot()
+            start = time.time()
+            run_script(workdir, [csv_path, '--crawl-cache', crawl_cache, '--rate', '0'] + extra_args + script_args)
+            elapsed = time.time() - start
+            (requests_after, bytes_after) = server.counters.snapshot()
+
+            print "%-12s %9.2f %9.1f %9.1f %10.2f %12.3f %12.3f" % (
+                scenario,
+                elapsed,
+                len(dataset.books) / elapsed,
+                (bytes_after - bytes_before) / 1e6 / elapsed,
+                float(requests_after - requests_before) / len(dataset.books),
+                gsb.metrics.timers['parse_sections'][1],
+                gsb.metrics.timers['compare_file_with_headers'][1])
+    finally:
+        server.shutdown()
+        if args.keep:
+            print "Left files in %s" % tmpdir
+        else:
+            shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
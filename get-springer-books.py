@@ -1,84 +1,105 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import bs4
+import calendar
 import codecs
 import collections
+import contextlib
 import csv
-import glob
+import difflib
+import email.utils
 import hashlib
-import operator
+import json
+import lxml.etree
+import lxml.html
+import mmap
+import multiprocessing
 import os
+import pickle
+import Queue
+import random
 import re
 import requests
 import requests_cache
+import requests_cache.backends.base
+import requests_cache.backends.storage.dbdict
+import socket
+import sqlite3
 import sys
+import threading
 import time
 import urllib
 import urllib2
+import urlparse
+import zlib
 
-clean_titles = {
-    '10.1007/978-1-4612-5142-2': 'SL_2(R)',
-    '10.1007/BFb0058395': 'Les Foncteurs Dérivés de lim<- et leurs Applications en Théorie des Modules',
-    '10.1007/BFb0096358': 'New Classes of L^P−spaces',
-    '10.1007/BFb0058801': 'Séminaire Bourbaki vol. 1968-69 Exposés 347-363',
-    '10.1007/BFb0058820': 'Séminaire Bourbaki vol. 1969-70 Exposés 364–381',
-    '10.1007/BFb0058692': 'Séminaire Bourbaki vol. 1970-71 Exposés 382–399',
-    '10.1007/BFb0069272': 'Séminaire Bourbaki vol. 1971-72 Exposés 400–417',
-    '10.1007/BFb0058692': 'Séminaire Bourbaki vol. 1970-71 Exposés 382–399',
-    '10.1007/BFb0057298': 'Séminaire Bourbaki vol. 1972-73 Exposés 418–435',
-    '10.1007/BFb0066360': 'Séminaire Bourbaki vol. 1973-74 Exposés 436–452',
-    '10.1007/BFb0080053': 'Séminaire Bourbaki vol. 1974-75 Exposés 453–470',
-    '10.1007/BFb0096057': 'Séminaire Bourbaki vol. 1975-76 Exposés 471–488',
-    '10.1007/BFb0070748': 'Séminaire Bourbaki vol. 1976-77 Exposés 489–506',
-    '10.1007/BFb0069969': 'Séminaire Bourbaki vol. 1977-78 Exposés 507–524',
-    '10.1007/BFb0096231': 'Séminaire Bourbaki vol. 1978-79 Exposés 525 – 542',
-    '10.1007/BFb0089923': 'Séminaire Bourbaki vol. 1979-80 Exposés 543 – 560',
-    '10.1007/BFb0097185': 'Séminaire Bourbaki vol. 1980-81 Exposés 561–578',
-    '10.1007/BFb0089463': 'Séminaire de Probabilités XIV 1978-79',
-    '10.1007/BFb0075834': 'Séminaire de Probabilités XIX 1983-84',
-    '10.1007/BFb0088355': 'Séminaire de Probabilités XV 1979-80',
-    '10.1007/BFb0092765': 'Séminaire de Probabilités XVI 1980-81',
-    '10.1007/BFb0092646': 'Séminaire de Probabilités XVI, 1980-81 Supplément: Géométrie Différentielle Stochastique',
-    '10.1007/BFb0068294': 'Séminaire de Probabilités XVII 1981-82',
-    '10.1007/BFb0100027': 'Séminaire de Probabilités XVIII 1982-83',
-    '10.1007/BFb0075705': 'Séminaire de Probabilités XX 1984-85',
-    '10.1007/BFb0083752': 'Séminaire de Probabilités XXIV 1988-89',
-    '10.1007/BFb0077395': 'Séminaire Pierre Lelong (Analyse) Année 1973-74',
-    '10.1007/BFb0077993': 'Séminaire Pierre Lelong (Analyse) Année 1974-75',
-    '10.1007/BFb0091458': 'Séminaire Pierre Lelong (Analyse) Année 1975-76',
-    '10.1007/BFb0097744': 'Séminaire Pierre Lelong - Henri Skoda (Analyse) Années 1978-79',
-    '10.1007/BFb0063241': 'Séminaire Pierre Lelong — Henri Skoda (Analyse) Année 1976-77',
-    '10.1007/BFb0097040': 'Séminaire Pierre Lelong-Henri Skoda (Analyse) Années 1980-81',
-}
+class FrozenDict(collections.Mapping):
+    """A read-only dict."""
 
-def cleanup_title(raw_title, doi):
-    if doi in clean_titles:
-        return clean_titles[doi].decode('utf8', 'strict')
-    return raw_title.decode('utf8', 'strict')
+    def __init__(self, *args, **kwargs):
+        self.d = dict(*args, **kwargs)
 
-too_many_authors = {
-    '10.1007/BFb0070748',
-}
+    def __getitem__(self, key):
+        return self.d[key]
 
-def cleanup_authors(raw_authors, doi):
-    authors = raw_authors
+    def __iter__(self):
+        return iter(self.d)
 
-    if doi in too_many_authors:
-        return u''
+    def __len__(self):
+        return len(self.d)
+
+# The hand-kept title fixups live in a data file next to the script.
+data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'get-springer-books-data.json')
+
+def load_cleanup_tables(paths):
+    """Returns (clean_titles, too_many_authors, clean_section_titles)
+    from the given data files, with later files overriding earlier
+    ones."""
+    clean_titles = {}
+    too_many_authors = set()
+    clean_section_titles = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = json.load(f)
+        clean_titles.update(data.get('clean_titles', {}))
+        too_many_authors.update(data.get('too_many_authors', []))
+        clean_section_titles.update(data.get('clean_section_titles', {}))
+    return (FrozenDict(clean_titles), frozenset(too_many_authors), FrozenDict(clean_section_titles))
 
+def set_cleanup_tables(tables):
+    global clean_titles, too_many_authors, clean_section_titles
+    (clean_titles, too_many_authors, clean_section_titles) = tables
+
+(clean_titles, too_many_authors, clean_section_titles) = load_cleanup_tables([data_path])
+
+def cleanup_title(raw_title, doi):
+    if doi in clean_titles:
+        return clean_titles[doi]
+    return raw_title.decode('utf8', 'strict')
+
+author_fixups = [
     # Handle this as a special case to avoid catching initials.
-    authors = re.sub(r"Jr\.([A-Z])", r'Jr., \1', authors)
+    (re.compile(r"Jr\.([A-Z])"), r'Jr., \1'),
 
     # This won't work for names that have mixed casing, but that seems
     # to be rare, except for initials and 'PhD'.
-    authors = re.sub(r"([^- '’.A-Z])([A-Z])", r'\1, \2', authors)
+    (re.compile(r"([^- '’.A-Z])([A-Z])"), r'\1, \2'),
 
     # Fixup PhD.
-    authors = re.sub('Ph, D', 'PhD', authors)
+    (re.compile('Ph, D'), 'PhD'),
 
     # Fixup "PhD{Name}"
-    authors = re.sub(r"PhD([A-Z])", r'PhD, \1', authors)
+    (re.compile(r"PhD([A-Z])"), r'PhD, \1'),
+]
+
+def cleanup_authors(raw_authors, doi):
+    authors = raw_authors
+
+    if doi in too_many_authors:
+        return u''
+
+    for (pattern, replacement) in author_fixups:
+        authors = pattern.sub(replacement, authors)
 
     return authors.decode('utf8', 'strict')
 
@@ -86,7 +107,11 @@ def get_doi_suffix(doi):
     doi_suffix = doi.split('/')[1]
     return doi_suffix
 
-def build_full_title(raw_title, year, raw_authors, doi):
+# The cleaned-up names of a book, which are needed several times
+# over a run.
+BookNames = collections.namedtuple('BookNames', ['title', 'authors', 'full_title', 'filename', 'old_filenames'])
+
+def build_book_names(raw_title, year, raw_authors, doi):
     title = cleanup_title(raw_title, doi)
     authors = cleanup_authors(raw_authors, doi)
     doi_suffix = get_doi_suffix(doi)
@@ -94,18 +119,8 @@ def build_full_title(raw_title, year, raw_authors, doi):
         full_title = "%s - %s (%s) (%s)" % (title, authors, year, doi_suffix)
     else:
         full_title = "%s (%s) (%s)" % (title, year, doi_suffix)
-    return full_title
-
-def build_filename(raw_title, year, raw_authors, doi):
-    full_title = build_full_title(raw_title, year, raw_authors, doi)
     filename = "%s.pdf" % (full_title)
-    return filename
 
-def build_pdf_url(doi):
-    pdf_url = "http://link.springer.com/content/pdf/%s.pdf" % (doi)
-    return pdf_url
-
-def build_old_filenames(raw_title, year, raw_authors, doi):
     # v1, just glom the raw title, year, and raw authors together.
     old_filenames = []
     old_filenames.append(("%s - %s (%s).pdf" % (raw_title, raw_authors, year)).decode('utf8', 'strict'))
@@ -114,19 +129,133 @@ def build_old_filenames(raw_title, year, raw_authors, doi):
     # (ignoring the case where authors is empty).
     #
     # TODO: Handle old author-splitting method.
-    title = cleanup_title(raw_title, doi)
-    authors = cleanup_authors(raw_authors, doi)
     old_filenames.append("%s - %s (%s).pdf" % (title, authors, year))
 
     # v3, omit dash when authors is empty.
     if len(authors) == 0:
         old_filenames.append("%s (%s).pdf" % (title, year))
 
-    return old_filenames
+    return BookNames(title, authors, full_title, filename, tuple(old_filenames))
+
+# Overridden by the benchmark to point at a local server.
+springer_url = 'http://link.springer.com'
+
+def build_pdf_url(doi):
+    pdf_url = "%s/content/pdf/%s.pdf" % (springer_url, doi)
+    return pdf_url
+
+# DOI suffixes don't contain any of these, so they show up as whole
+# tokens in file names, e.g. 978-1-4684-0047-2.pdf or
+# "Title - Authors (1999) (978-1-4684-0047-2).pdf".
+filename_token_separators = re.compile(r'[\s()\[\],/]+', re.UNICODE)
 
-def rename(raw_title, year, raw_authors, doi, url):
-    candidate_filenames = build_old_filenames(raw_title, year, raw_authors, doi)
-    filename = build_filename(raw_title, year, raw_authors, doi)
+def get_filename_tokens(name):
+    # Escaped DOIs (from the URL) have the / as %2F.
+    (base, ext) = os.path.splitext(urllib.unquote(name))
+    return [token for token in filename_token_separators.split(base) if token]
+
+class FileIndex(object):
+    """Index of the files and directories under root, from a single walk.
+
+    Entries are looked up by name or by a token in their name (like a
+    DOI suffix), and are kept up to date as they are moved. Hidden
+    files and directories and unfinished .part downloads are left
+    out.
+    """
+
+    def __init__(self, root):
+        self.paths = set()
+        self.dirs = set()
+        self.by_name = collections.defaultdict(set)
+        self.by_token = collections.defaultdict(set)
+        for (dirpath, dirnames, filenames) in os.walk(root):
+            # Don't walk into hidden directories.
+            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+            for name in dirnames:
+                self.add(os.path.normpath(os.path.join(dirpath, name)), True)
+            for name in filenames:
+                if name.startswith('.') or name.endswith('.part'):
+                    continue
+                self.add(os.path.normpath(os.path.join(dirpath, name)), False)
+
+    def add(self, path, is_dir):
+        self.paths.add(path)
+        if is_dir:
+            self.dirs.add(path)
+        name = os.path.basename(path)
+        self.by_name[name].add(path)
+        for token in get_filename_tokens(name):
+            self.by_token[token].add(path)
+
+    def remove(self, path):
+        self.paths.discard(path)
+        self.dirs.discard(path)
+        name = os.path.basename(path)
+        self.by_name[name].discard(path)
+        for token in get_filename_tokens(name):
+            self.by_token[token].discard(path)
+
+    def exists(self, path):
+        return path in self.paths
+
+    def find_files_by_name(self, name):
+        # Only in root itself.
+        return sorted(path for path in self.by_name.get(name, ()) if path == name and path not in self.dirs)
+
+    def find_by_token(self, token, dirs, parents):
+        # parents are the directories to look in, with '' for root.
+        return sorted(path for path in self.by_token.get(token, ()) if (path in self.dirs) == dirs and os.path.dirname(path) in parents)
+
+    def move(self, old_path, new_path):
+        (dirname, filename) = os.path.split(new_path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+            self.add(dirname, True)
+        os.rename(old_path, new_path)
+        is_dir = old_path in self.dirs
+        if is_dir:
+            # Everything under the directory moves with it.
+            prefix = old_path + os.sep
+            for path in [path for path in self.paths if path.startswith(prefix)]:
+                self.remove(path)
+                self.add(new_path + path[len(old_path):], path in self.dirs)
+        self.remove(old_path)
+        self.add(new_path, is_dir)
+
+def rename_into_place(index, manifest, path, token, dirs, parents):
+    # Look for exactly one other file (or directory) with token in its
+    # name in one of parents and move it to path.
+    candidates = index.find_by_token(token, dirs, parents)
+    if len(candidates) > 1:
+        print "Found files %s, skipping" % (candidates)
+    elif len(candidates) == 1 and candidates[0] != path:
+        print "Found %s, renaming to %s" % (candidates[0], path)
+        index.move(candidates[0], path)
+        manifest.rename_path(candidates[0], path)
+
+def rename(index, manifest, names, doi, url):
+    candidate_filenames = list(names.old_filenames)
+    filename = names.filename
+    doi_suffix = get_doi_suffix(doi)
+
+    record = manifest.get_book(doi)
+    if record is not None and record['sections'] is not None:
+        # Only the chapters are available, so look for the book's
+        # directory and then move each chapter into it.
+        full_title = names.full_title
+        if not index.exists(full_title):
+            rename_into_place(index, manifest, full_title, doi_suffix, True, ('',))
+        paths = build_section_paths(full_title, record['sections'])
+        for ((title, section_url, section_doi), path) in zip(record['sections'], paths):
+            # Loose chapters are pulled in from the current directory
+            # too, but not from other books' directories.
+            if section_doi and not index.exists(path):
+                rename_into_place(index, manifest, path, get_doi_suffix(section_doi), False, ('', full_title))
+        return
+
+    if manifest.lookup_file(filename, False) is not None:
+        # Already verified under its current name.
+        return
 
     # The DOI in the URL is usually escaped.
     t = url.split('/')
@@ -134,24 +263,218 @@ def rename(raw_title, year, raw_authors, doi, url):
     candidate_filenames.insert(0, pdf_filename)
 
     for candidate in candidate_filenames:
-        if os.path.isfile(candidate):
-            print "Found %s, renaming to %s" % (candidate, filename)
-            os.rename(candidate, filename)
+        found = index.find_files_by_name(candidate)
+        if len(found) == 1:
+            print "Found %s, renaming to %s" % (found[0], filename)
+            index.move(found[0], filename)
+            manifest.rename_path(found[0], filename)
             return
 
-    doi_suffix = doi.split('/')[1]
-    candidate_files = [f.decode('utf8', 'strict') for f in glob.glob('*%s*' % doi_suffix)]
-    if len(candidate_files) > 2:
-        print "Found files %s, skipping" % (candidate_files)
-    elif len(candidate_files) == 1 and candidate_files[0] != filename:
-        # TODO: This seems to fire even when some (Unicode?) filenames
-        # are the same. Figure out why.
-        print "Found %s, renaming to %s" % (candidate_files[0], filename)
-        os.rename(candidate_files[0], filename)
+    rename_into_place(index, manifest, filename, doi_suffix, False, ('',))
+
+class LRUDict(collections.MutableMapping):
+    """In-memory dict that drops the least recently used keys beyond max_entries.
+
+    A max_entries of 0 doesn't bound it.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.data = collections.OrderedDict()
+
+    def __getitem__(self, key):
+        with self.lock:
+            value = self.data.pop(key)
+            self.data[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while self.max_entries and len(self.data) > self.max_entries:
+                self.data.popitem(last=False)
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+
+    def __iter__(self):
+        with self.lock:
+            return iter(self.data.keys())
+
+    def __len__(self):
+        with self.lock:
+            return len(self.data)
+
+class CrawlCacheDict(requests_cache.backends.storage.dbdict.DbDict):
+    """DbDict that keeps a single connection open and stays bounded.
+
+    codec is None to store values as is, 'pickle' to pickle them like
+    DbPickleDict (so existing crawl caches still load), or 'zlib' to
+    also compress them. Beyond max_entries rows (unless 0), the oldest
+    written rows are dropped.
+    """
+
+    def __init__(self, filename, table_name, codec, max_entries):
+        self.codec = codec
+        self.max_entries = max_entries
+        self.writes = 0
+        self.con = sqlite3.connect(filename, check_same_thread=False)
+        super(CrawlCacheDict, self).__init__(filename, table_name)
+
+    @contextlib.contextmanager
+    def connection(self, commit_on_success=False):
+        # Opening a connection per operation (like DbDict does) is
+        # most of the cost of a cache hit.
+        with self._lock:
+            try:
+                yield self.con
+            except:
+                # DbDict.__delitem__ raises KeyError after its DELETE
+                # found nothing. Left open, that write transaction would
+                # lock the other tables' connections out of the file.
+                self.con.rollback()
+                raise
+            if commit_on_success:
+                self.con.commit()
+
+    def __getitem__(self, key):
+        value = super(CrawlCacheDict, self).__getitem__(key)
+        if self.codec == 'zlib':
+            return pickle.loads(zlib.decompress(bytes(value)))
+        elif self.codec == 'pickle':
+            return pickle.loads(bytes(value))
+        return value
+
+    def __setitem__(self, key, value):
+        if self.codec == 'zlib':
+            value = sqlite3.Binary(zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+        elif self.codec == 'pickle':
+            value = sqlite3.Binary(pickle.dumps(value))
+        super(CrawlCacheDict, self).__setitem__(key, value)
+
+        # Counting rows isn't free, so only check every so often.
+        self.writes += 1
+        if self.max_entries and self.writes % 100 == 0:
+            with self.connection(True) as con:
+                excess = len(self) - self.max_entries
+                if excess > 0:
+                    con.execute("delete from `%s` where rowid in (select rowid from `%s` order by rowid limit ?)" % (self.table_name, self.table_name), (excess,))
+
+class CrawlCache(requests_cache.backends.base.BaseCache):
+    """requests_cache backend with expiry, size bounds and hit counts.
+
+    responses, keys_map and meta are dict-like stores; meta holds the
+    kind of each response ('ok', 'not_found' or 'redirect') and when
+    it was saved, so that expiry can be checked without unpickling
+    the response. ttls maps each kind to how many seconds its
+    responses stay fresh, or None for forever.
+    """
+
+    def __init__(self, responses, keys_map, meta, ttls):
+        super(CrawlCache, self).__init__()
+        self.responses = responses
+        self.keys_map = keys_map
+        self.meta = meta
+        self.ttls = ttls
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def save_response(self, key, response):
+        super(CrawlCache, self).save_response(key, response)
+        self.meta[key] = (get_response_kind(response), time.time())
+
+    def resolve(self, key):
+        # Returns the key the response for key is stored under, if any.
+        if key in self.responses:
+            return key
+        main_key = self.keys_map.get(key)
+        if main_key is not None and main_key in self.responses:
+            return main_key
+        return None
+
+    def is_fresh(self, main_key):
+        meta = self.meta.get(main_key)
+        if meta is None:
+            # Saved before expiry was tracked, so fill it in.
+            (response, timestamp) = super(CrawlCache, self).get_response_and_time(main_key)
+            if response is None:
+                return False
+            meta = (get_response_kind(response), calendar.timegm(timestamp.utctimetuple()))
+            self.meta[main_key] = meta
+        (kind, saved_at) = meta
+        ttl = self.ttls[kind]
+        return ttl is None or time.time() - saved_at <= ttl
+
+    def get_response_and_time(self, key, default=(None, None)):
+        with metrics.timer('crawl_cache_lookup'):
+            return self.get_response_and_time_untimed(key, default)
+
+    def get_response_and_time_untimed(self, key, default):
+        result = default
+        main_key = self.resolve(key)
+        if main_key is not None:
+            if self.is_fresh(main_key):
+                result = super(CrawlCache, self).get_response_and_time(main_key, default)
+            else:
+                self.delete(main_key)
+        with self.lock:
+            if result[0] is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return result
+
+    def has_key(self, key):
+        main_key = self.resolve(key)
+        return main_key is not None and self.is_fresh(main_key)
+
+    def delete(self, key):
+        main_key = self.resolve(key)
+        super(CrawlCache, self).delete(key)
+        if main_key is not None:
+            self.meta.pop(main_key, None)
+
+    def get_stats(self):
+        return "Crawl cache: %d hits, %d misses, %d responses stored" % (self.hits, self.misses, len(self.responses))
+
+def get_response_kind(response):
+    if response.status_code == 404:
+        return 'not_found'
+    if response.history:
+        return 'redirect'
+    return 'ok'
+
+def build_crawl_cache(backend, location, max_entries, ttls):
+    if backend == 'memory':
+        def make_store(table_name, codec):
+            return LRUDict(max_entries)
+    else:
+        if backend == 'compressed':
+            filename = location + '-compressed.sqlite'
+        else:
+            # The same file and tables as requests_cache's own sqlite
+            # backend, so existing crawl caches keep working.
+            filename = location + '.sqlite'
+
+        def make_store(table_name, codec):
+            if backend == 'compressed' and codec == 'pickle':
+                codec = 'zlib'
+            return CrawlCacheDict(filename, table_name, codec, max_entries)
+
+    return CrawlCache(make_store('responses', 'pickle'), make_store('urls', None), make_store('meta', 'pickle'), ttls)
 
 def head_url(crawl_session, url):
     request = crawl_session.prepare_request(requests.Request('HEAD', url))
-    response = crawl_session.send(request, allow_redirects=True)
+    with metrics.timer('head_url'):
+        response = crawl_session.send(request, allow_redirects=True)
     if response.url.find('no-access=true') >= 0:
         # Don't cache this response.
         k = crawl_session.cache.create_key(request)
@@ -159,207 +482,1002 @@ def head_url(crawl_session, url):
         raise Exception("access denied to %s" % url)
     return response
 
-def url_exists(crawl_session, url):
-    response = head_url(crawl_session, url)
-    return response.status_code == 200
-
-clean_section_titles = {
-    '10.1007/BFb0060880': u'Functional interpretation of classical (AC)o-, (ωAC)-analysis with (ER)-qf and functional interpretation in the narrower sense of Heyting-analysis plus (ER)-qf, (MP), ... in T⋃BR',
-    '10.1007/BFb0091368': u'Evaporation and condensation of a rarefied gas between its two parallel plane condensed phases with different temperatures and negative temperature-gradient phenomenon',
-    '10.1007/BFb0077580': u'Asymptotic expressions for the remainders associated to expansions of type $$\\sum\\limits_{n = 0}^\\infty { c_n \\frac{{z^n }}{{n!}}, } \\sum\\limits_{n = 0}^\\infty { c_n z^n and } \\sum\\limits_{n = 0} { c_n n!z^n }$$',
-    '10.1007/BFb0077925': u'A solution of the integral equation $$\\int_0^\\infty {(\\sin (\\frac{\\pi }{4} + \\theta )e^{ - \\theta y} + \\sin (\\frac{\\pi }{4} - \\theta )e^{\\theta y} )\\pi (x,y)dy = \\surd 2 cosh \\theta x}$$ in convolution form',
-    '10.1007/BFb0099702': u'Der Begriff der charakteristischen Funktion. Nevanlinnas Charakterisierung rationaler Stellen',
-    '10.1007/BFb0089525': u'On the boundary map K3(Δ over I) → K2(Δ,I)',
-    '10.1007/BFb0089528': u'On a conjecture concerning K*(ZZ over p2)',
-    '10.1007/BFb0083034': u'The RO(G)-graded equivariant ordinary cohomology of complex projective spaces with linear ℤ over p actions',
-    '10.1007/BFb0087506': u'Lannes\' division functors on summands of H*(B(Z over p)r)',
-    '10.1007/BFb0077797': u'Maps of BZ over pZ to BG',
-    '10.1007/BFb0082258': u'Divisorial cycles on a normal projective variety V over k (dim(V)=r≥1)',
-    '10.1007/BFb0096456': u'The zeros of Hurwitz\'s zeta-function on σ=1 over 2',
-    '10.1007/BFb0093310': u'Uniform twin-convergence regions for continued fractions K(an over 1)',
-    '10.1007/BFb0093315': u'Parameterizations and factorizations of element regions for continued fractions K(an over 1)',
-    '10.1007/BFb0093305': u'Convergence acceleration for continued fractions K(an over 1) with lim an=0',
-    '10.1007/BFb0093306': u'Truncation error analysis for continued fractions K(an over 1) where $$\\sqrt {\\left| {a_n } \\right|} + \\sqrt {\\left | {a_{n - 1} } \\right|} < 1$$',
-    '10.1007/BFb0093307': u'A method for convergence acceleration of continued fractions K(an over 1)',
-    '10.1007/BFb0075943': u'On the convergence of a certain class of continued fractions K(an over 1) with an→∞',
-    '10.1007/BFb0075934': u'On the convergence of limit periodic continued fractions K(an over 1), where an→−1 over 4. Part II',
-    '10.1007/BFb0075935': u'A theorem on simple convergence regions for continued fractions K(an over 1)',
-    '10.1007/BFb0075937': u'Oval convergence regions and circular limit regions for continued fractions K(an over 1)',
-    '10.1007/BFb0062370': u'Slow or fast decoupling for linear boundary value problems',
-    '10.1007/BFb0085399': u'Universal unfolding of a singularity of a symmetric vector field with 7-jet C∞-equivalent to y ∂_x+(±x3 ±x6y) ∂_y',
-    '10.1007/BFb0069190': u'A problem in the design of electrical circuits, a generalized subadditive inequality and the recurrence relation j(n,m)=j([n over 2],m)+j([n+1 over 2],m)+j(n,m–1)',
-    '10.1007/BFb0099365': u'In characteristic p=2 the Veronese variety Vm ⊂ ℙm(m+3) over 2 and each of its generic projection is set-theoretic complete intersection',
-    '10.1007/978-3-540-44885-3_6': u'6. Anisotropic linear over superlinear growth in the scalar case',
-    '10.1007/BFb0075653': u'Remarks on the injectivity radius estimate for almost 1 over 4-pinched manifolds',
-    '10.1007/BFb0073501': u'K over J inequalities and limiting embedding theorems',
-    '10.1007/BFb0089866': u'L2(Γ over G, X)',
-    '10.1007/BFb0089868': u'Spectral decomposition of eL2(Γ over G,X)',
-    '10.1007/BFb0069227': u'Algebraic k-theory with coefficients $$\\underset{\\raise0.3em\\hbox{$\\smash{\\scriptscriptstyle\\thicksim}$}}{Z}$$  over p',
-    '10.1007/BFb0092021': u'Classical 1 over 2 spin particles interacting with gravitational fields: A supersymmetric model',
-    '10.1007/BFb0097473': u'Produits star sur certains G over K Kähleriens. equation de Yang-Baxter et produits star sur G',
-    '10.1007/BFb0083630': u'Compact manifolds with 1 over 4-pinched negative curvature',
-    '10.1007/BFb0101504': u'Vector fields and cohomology of G over P',
-    '10.1007/BFb0076176': u'Some finite groups which appear as gal L over K, where K⊂Q(μn)',
-    '10.1007/BFb0086588': u'Le noyau de la chaleur sur les espaces symetriques U(p,q) over U(p)×U(q)',
-    '10.1007/BFb0064139': u'Comparison between I(RT:ST), WT(HN over HS+N), and JT(N, S+N) for gaussian signals and noise',
-    '10.1007/BFb0062095': u'Differential or algebraic systems and matrix pencils',
-    '10.1007/BFb0065296': u'Modular forms of weight 1 over 2',
-    '10.1007/BFb0072655': u'Fas multigrid employing ILU or SIP smoothing: A robust fast solver for 3D transonic potential flow',
-    '10.1007/BFb0090406': u'K-finite joint eigenfunctions of U(g)K on a non-riemannian semisimple symmetric space G over H',
-    '10.1007/BFb0087923': u'Spherical functions in spin0(1,d) over Spin(d−1) for d=2,4 and 8',
-    '10.1007/BFb0077579': u'Asymptotic expressions for the remainders associated to expansions of type $$\\sum\\limits_{n = 0}^\\infty { c_n \\frac{{z^n }}{{n!}}, } \\sum\\limits_{n = 0}^\\infty { c_n z^n and } \\sum\\limits_{n = 0} { c_n n!z^n }$$',
-    '10.1007/BFb0064888': u'Automatic detection and treatment of oscillatory and or stiff ordinary differential equations',
-    '10.1007/BFb0058574': u'Structure of (D) for D with c=1 over 2',
-    '10.1007/BFb0090907': u'Analysis of a recursive 5-point over 9-point factorization method',
-    '10.1007/BFb0068793': u'Relative consistency proof of ZTN with respect to ZTi over IN*',
-    '10.1007/BFb0072415': u'On the convergence of limit periodic continued fractions K(an over 1), where a1 → −1 over 4',
-    '10.1007/BFb0072463': u'Convergence acceleration for continued fractions K(an over 1), where an → ∞',
-    '10.1007/BFb0076225': u'On the ordering of classes in high or low hierarchies',
-    '10.1007/BFb0068428': u'Le Foncteur $$\\underline {Pic} _{\\tilde X over k}^\\# $$ Pour Un R-Schéma Propre X',
-    '10.1007/BFb0058839': u'Table par noms d\'Auteurs [Séminaire Bourbaki, 1967-68 à 1969-70, Exposés 331 à 381]',
-    '10.1007/BFb0064855': u'Relations entre la série de Betti d\'un anneau local de Gorenstein R et celle de l\'anneau R over Socle R',
-    '10.1007/BFb0064842': u'Decomposition of exterior and symmetric powers of indecomposable Z over pZ-modules in characteristic p and relations to invariants',
-    '10.1007/BFb0077407': u'Rectificatif concernant l’expose: “Un théorème d’image directe propre”, publié dans le Séminaire Pierre Lelong, 1972-73, N° 410',
-    '10.1007/BFb0093747': u'Cellular or homology complexes: methods',
-    '10.1007/BFb0072245': u'Der Grenzefall k=n+j+1 over 2',
-    '10.1007/BFb0072246': u'Das holomorphe diskrete Spektrum von L 2(Γ n over G)',
-    '10.1007/BFb0060047': u'On meromorphic solutions of the difference equation y(x+1)=y(x)+1+λ over y(x)',
-    '10.1007/BFb0095839': u'The classification of three-dimensional homogeneous complex manifolds X=G over H where G is a complex lie group',
-    '10.1007/BFb0095840': u'The classification of three-dimensional homogeneous complex manifolds X=G over H where G is a real lie group',
-    '10.1007/BFb0072815': u'Free (ℤ over 2)k-actions and a problem in commutative algebra',
-}
+section_title_whitespace = re.compile(u'\s+')
 
 def cleanup_section_title(raw_title, doi):
     if doi in clean_section_titles:
         return clean_section_titles[doi]
-    clean_title = re.sub(u'\s+', u' ', raw_title)
+    clean_title = section_title_whitespace.sub(u' ', raw_title)
     return clean_title
 
-def get_sections(crawl_session, url):
-    response = crawl_session.get(url, allow_redirects=True)
-    soup = bs4.BeautifulSoup(response.text, 'lxml')
-    toc_items = soup.find_all('li', class_="toc-item")
+class TocCache(object):
+    """Caches the sections parsed out of each book's landing page.
+
+    Entries are keyed by book DOI and remember the crawl cache key of
+    the page they were parsed from, so an entry goes away along with
+    that page's crawl cache entry. Stored as JSON lines like the
+    manifest.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        line_count = 0
+        for record in read_json_lines(path):
+            line_count += 1
+            record['sections'] = [tuple(section) for section in record['sections']]
+            self.entries[record['doi']] = record
+        if line_count > 2 * len(self.entries) + 100:
+            write_json_lines(path, self.entries.values())
+        self.fd = open(path, 'ab')
+
+    def lookup(self, crawl_session, doi, key):
+        entry = self.entries.get(doi)
+        if entry is None or entry['key'] != key:
+            return None
+        if not crawl_session.cache.has_key(key):
+            return None
+        return entry['sections']
+
+    def add(self, doi, key, sections):
+        record = {'doi': doi, 'key': key, 'sections': sections}
+        with self.lock:
+            self.entries[doi] = record
+            self.fd.write(json.dumps(record) + '\n')
+            self.fd.flush()
+
+# Matches the same links as BeautifulSoup's find_all('li',
+# class_='toc-item') followed by find_all('a'), without building a
+# tree for the rest of the page.
+toc_links_xpath = lxml.etree.XPath("//li[contains(concat(' ', normalize-space(@class), ' '), ' toc-item ')]//a[@href]")
+
+def parse_sections(response):
+    parser = lxml.html.HTMLParser(encoding=response.encoding)
+    root = lxml.html.fromstring(response.content, parser=parser)
     sections = []
-    i = 1
-    for item in toc_items:
-        links = item.find_all('a')
-        for link in links:
-            url = link.get('href')
-            if url.endswith('.pdf'):
-                title = link.get('title')
-                doi = link.get('doi')
-                clean_title = cleanup_section_title(title, doi)
-                abs_url = u"http://link.springer.com%s" % url
-                sections.append((clean_title, abs_url, doi))
-                i += 1
+    for link in toc_links_xpath(root):
+        url = link.get('href')
+        if url.endswith('.pdf'):
+            # The titles are kept raw, and cleaned up whenever they're
+            # used, so that changes to clean_section_titles apply to
+            # books already in the manifest and the TOC cache.
+            title = link.get('title')
+            doi = link.get('doi')
+            abs_url = u"%s%s" % (springer_url, url)
+            sections.append((title, abs_url, doi))
     return sections
 
-def list_files(crawl_session, raw_title, year, raw_authors, doi, url):
-    full_title = build_full_title(raw_title, year, raw_authors, doi)
+def get_sections(crawl_session, toc_cache, doi, url):
+    request = crawl_session.prepare_request(requests.Request('GET', url))
+    key = crawl_session.cache.create_key(request)
+    sections = toc_cache.lookup(crawl_session, doi, key)
+    if sections is not None:
+        return sections
 
-    pdf_url = build_pdf_url(doi)
+    with metrics.timer('get_landing_page'):
+        response = crawl_session.get(url, allow_redirects=True)
+    if response.status_code != 200:
+        # Don't save an empty TOC for a page we didn't get.
+        raise Exception("Got HTTP %d for %s" % (response.status_code, url))
+    with metrics.timer('parse_sections'):
+        sections = parse_sections(response)
+    toc_cache.add(doi, key, sections)
+    return sections
+
+def build_list_entry(names, record):
+    full_title = names.full_title
+
+    pdf_url = record['pdf_url']
 
-    if url_exists(crawl_session, pdf_url):
-        print u"[%s](%s)\n" % (full_title, pdf_url)
+    if pdf_url is not None:
+        return u"[%s](%s)\n" % (full_title, pdf_url)
     else:
-        sections = get_sections(crawl_session, url)
+        sections = record['sections']
         i = 1
         link_strs = []
-        for (title, url, doi) in sections:
+        for (section_raw_title, url, section_doi) in sections:
+            title = cleanup_section_title(section_raw_title, section_doi)
             link_strs.append(u'<a href="%s" title="%s">[%d]</a>' % (url, title, i))
             i += 1
 
         all_link_str = u', '.join(link_strs)
-        print (u"%s (%s)\n" % (full_title, all_link_str))
+        return u"%s (%s)\n" % (full_title, all_link_str)
+
+def list_files(names, record):
+    log(build_list_entry(names, record))
+
+def write_list(path, entries, show_diff):
+    """Writes the markdown list to path, printing how it changed since
+    the last run if show_diff is set."""
+    text = u''.join(entry + u'\n' for entry in entries)
+    if show_diff:
+        old_text = u''
+        if os.path.exists(path):
+            with codecs.open(path, 'rb', 'utf8') as f:
+                old_text = f.read()
+        for line in difflib.unified_diff(old_text.splitlines(True), text.splitlines(True), path, path):
+            sys.stdout.write(line)
+    tmp_path = path + '.tmp'
+    with codecs.open(tmp_path, 'wb', 'utf8') as f:
+        f.write(text)
+    os.rename(tmp_path, path)
+
+def update_md5_from_file(md5, path, block_size=1024 * 1024):
+    # Hash through a memory map a block at a time, so memory use
+    # doesn't depend on the size of the file.
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            # Empty files can't be mapped.
+            return
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            with metrics.timer('md5_from_file'):
+                for offset in xrange(0, size, block_size):
+                    md5.update(m[offset:offset + block_size])
+        finally:
+            m.close()
+        metrics.count('bytes_hashed_from_file', size)
 
 def compute_file_md5(path):
-    return hashlib.md5(open(path, 'rb').read()).hexdigest()
+    md5 = hashlib.md5()
+    update_md5_from_file(md5, path)
+    return md5.hexdigest()
 
-def compare_file_with_headers(path, headers, check_md5):
+def get_etag_md5(etag):
+    return etag.strip(' \t\n\r"').split(':')[0]
+
+def compare_file_with_headers(path, headers, check_md5, md5=None):
+    with metrics.timer('compare_file_with_headers'):
+        return compare_file_with_headers_untimed(path, headers, check_md5, md5)
+
+def compare_file_with_headers_untimed(path, headers, check_md5, md5):
     expected_size = int(headers['Content-Length'])
     if check_md5:
-        etag = headers['ETag']
-        expected_md5 = etag.strip(' \t\n\r"').split(':')[0]
+        expected_md5 = get_etag_md5(headers['ETag'])
         expected = (expected_size, expected_md5)
     else:
         expected = expected_size
 
     size = os.path.getsize(path)
     if check_md5:
-        md5 = compute_file_md5(path)
+        # The caller may already have hashed the file while writing it.
+        if md5 is None:
+            md5 = compute_file_md5(path)
         actual = (size, md5)
     else:
         actual = size
 
     return (expected, actual)
 
-def download_file(crawl_session, download_session, dry, check_md5, url, path):
+def read_json_lines(path):
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def write_json_lines(path, records):
+    # Write to the side and rename, so path is never half-written.
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    os.rename(tmp_path, path)
+
+class Manifest(object):
+    """Remembers verified files and book availability between runs.
+
+    Records are appended to path as JSON lines, and later records
+    override earlier ones. A file record is only trusted while the
+    file's size and mtime are still the ones that were verified. An
+    empty path keeps the manifest in memory only.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+        self.books = {}
+        # Book records checked longer ago than this many seconds are
+        # treated as missing, so that the book gets checked again.
+        self.max_book_age = None
+        self.fd = None
+        if not path:
+            return
+
+        line_count = 0
+        for record in read_json_lines(path):
+            line_count += 1
+            self.load_record(record)
+        if line_count > 2 * (len(self.files) + len(self.books)) + 100:
+            # Drop superseded records.
+            write_json_lines(path, self.books.values() + self.files.values())
+        self.fd = open(path, 'ab')
+
+    def load_record(self, record):
+        if record['type'] == 'file':
+            self.files[record['path']] = record
+        elif record['type'] == 'deleted':
+            self.files.pop(record['path'], None)
+        elif record['type'] == 'book':
+            if record['sections'] is not None:
+                record['sections'] = [tuple(section) for section in record['sections']]
+            self.books[record['doi']] = record
+
+    def write(self, record):
+        with self.lock:
+            self.load_record(record)
+            if self.fd:
+                self.fd.write(json.dumps(record) + '\n')
+                self.fd.flush()
+
+    def get_file(self, path):
+        # Unlike lookup_file(), doesn't check that the file is unchanged.
+        return self.files.get(path)
+
+    def lookup_file(self, path, check_md5):
+        record = self.files.get(path)
+        if record is None:
+            return None
+        if check_md5 and not record['md5']:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_size != record['size'] or st.st_mtime != record['mtime']:
+            return None
+        return record
+
+    def add_file(self, doi, path, md5, etag):
+        st = os.stat(path)
+        self.write({
+            'type': 'file',
+            'doi': doi,
+            'path': path,
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'md5': md5,
+            'etag': etag,
+        })
+
+    def rename_path(self, old_path, new_path):
+        # old_path may also be a directory with recorded files under it.
+        prefix = old_path + os.sep
+        for path in self.files.keys():
+            if path == old_path or path.startswith(prefix):
+                record = dict(self.files[path], path=new_path + path[len(old_path):])
+                self.write({'type': 'deleted', 'path': path})
+                self.write(record)
+
+    def get_book(self, doi):
+        # Unlike lookup_book(), doesn't check how old the record is.
+        return self.books.get(doi)
+
+    def lookup_book(self, doi):
+        record = self.books.get(doi)
+        if record is None:
+            return None
+        if self.max_book_age is not None and record.get('checked', 0) < time.time() - self.max_book_age:
+            return None
+        return record
+
+    def add_book(self, doi, pdf_url, sections):
+        # Exactly one of pdf_url (the whole book is available) and
+        # sections (only the chapters are) is set.
+        self.write({
+            'type': 'book',
+            'doi': doi,
+            'pdf_url': pdf_url,
+            'sections': sections,
+            'checked': time.time(),
+        })
+
+class Metrics(object):
+    """Counters and timers for a run, safe to update from any thread."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.counters = collections.defaultdict(int)
+        # name -> [calls, seconds]
+        self.timers = collections.defaultdict(lambda: [0, 0.0])
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                timer = self.timers[name]
+                timer[0] += 1
+                timer[1] += elapsed
+
+    def get_report(self, crawl_cache):
+        with self.lock:
+            report = {
+                'elapsed_seconds': time.time() - self.start,
+                'counters': dict(self.counters),
+                'timers': dict((name, {'calls': calls, 'seconds': seconds}) for (name, (calls, seconds)) in self.timers.items()),
+            }
+        report['counters']['crawl_cache_hits'] = crawl_cache.hits
+        report['counters']['crawl_cache_misses'] = crawl_cache.misses
+        return report
+
+    def write_report(self, path, crawl_cache):
+        # A .prom path gets the Prometheus textfile format (e.g., for
+        # node_exporter's textfile collector), anything else JSON.
+        report = self.get_report(crawl_cache)
+        lines = []
+        if path.endswith('.prom'):
+            lines.append('get_springer_books_elapsed_seconds %f' % report['elapsed_seconds'])
+            for (name, value) in sorted(report['counters'].items()):
+                lines.append('get_springer_books_%s_total %d' % (name, value))
+            for (name, timer) in sorted(report['timers'].items()):
+                lines.append('get_springer_books_%s_calls_total %d' % (name, timer['calls']))
+                lines.append('get_springer_books_%s_seconds_total %f' % (name, timer['seconds']))
+        else:
+            lines.append(json.dumps(report, indent=2, sort_keys=True))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp_path, path)
+
+metrics = Metrics()
+
+class Progress(object):
+    """Keeps a line on stderr with books done, throughput and ETA.
+
+    On a terminal the line is redrawn in place (and cleared by log()
+    before other output); otherwise a new line is written each time.
+    """
+
+    def __init__(self, total, interval):
+        self.total = total
+        self.interval = interval
+        self.tty = sys.stderr.isatty()
+        self.showing = False
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        self.show()
+        if self.tty:
+            sys.stderr.write('\n')
+        self.showing = False
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.show()
+
+    def clear(self):
+        if self.showing:
+            sys.stderr.write('\r\x1b[K')
+            self.showing = False
+
+    def show(self):
+        with metrics.lock:
+            elapsed = time.time() - metrics.start
+            books = metrics.counters['books_done']
+            bytes = metrics.counters['bytes_downloaded']
+        line = "%d%s books, %.1f books/s, %.1f MB/s" % (books, '/%d' % self.total if self.total is not None else '', books / elapsed, bytes / 1e6 / elapsed)
+        if self.total is not None and books > 0:
+            eta = int((self.total - books) * elapsed / books)
+            line += ", ETA %dh%02dm%02ds" % (eta / 3600, eta / 60 % 60, eta % 60)
+        with output_lock:
+            if self.tty:
+                sys.stderr.write('\r\x1b[K' + line)
+                self.showing = True
+            else:
+                sys.stderr.write(line + '\n')
+            sys.stderr.flush()
+
+output_lock = threading.Lock()
+progress = None
+
+def log(message, out=None):
+    # Keep lines from concurrent downloads from interleaving.
+    with output_lock:
+        if progress is not None:
+            progress.clear()
+        if out is None:
+            out = sys.stdout
+        print >> out, message
+
+def log_error(message):
+    # Diagnostics go to stderr, so they stay out of a --list on stdout.
+    # Unlike stdout, stderr isn't wrapped to encode file names.
+    if isinstance(message, unicode):
+        message = message.encode('utf8')
+    log(message, sys.stderr)
+
+class WorkPool(object):
+    """Runs submitted calls on a bounded number of worker threads.
+
+    With a single job, calls run right away in the calling thread, so
+    the output and error behavior is the same as a plain loop. Calls
+    may submit more calls (e.g., one per chapter); join() waits for all
+    of them and re-raises the first exception raised by any call.
+    """
+
+    def __init__(self, jobs):
+        self.queue = Queue.Queue()
+        self.errors = []
+        self.threads = []
+        if jobs > 1:
+            for i in xrange(0, jobs):
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, func, *args):
+        if not self.threads:
+            func(*args)
+            return
+        self.queue.put((func, args))
+
+    def work(self):
+        while True:
+            (func, args) = self.queue.get()
+            try:
+                # Drain the queue without doing anything after a failure.
+                if not self.errors:
+                    func(*args)
+            except:
+                self.errors.append(sys.exc_info())
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        # Queue.join() can't be interrupted with Ctrl-C, so wait with a
+        # timeout instead.
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                self.queue.all_tasks_done.wait(0.5)
+        self.check()
+
+    def check(self):
+        if self.errors:
+            (exc_type, exc_value, exc_traceback) = self.errors[0]
+            raise exc_type, exc_value, exc_traceback
+
+class RequestScheduler(object):
+    """Paces, limits and retries the requests sent to each host.
+
+    Requests are released by a token bucket, which halves its rate
+    when a host throttles us (with a 429 or 503) and creeps back up to
+    rate as requests succeed. Each host gets at most per_host requests
+    at a time, and failed requests are retried with exponential backoff
+    and jitter, waiting at least as long as any Retry-After asks for.
+    A rate of 0 doesn't limit the rate at all.
+    """
+
+    def __init__(self, rate, per_host, max_retries, base_delay=1.0, max_delay=60.0, clock=time.time, sleep=time.sleep):
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.per_host = per_host
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = 1.0
+        self.last_refill = clock()
+        self.semaphores = {}
+
+    def wait_for_token(self):
+        if self.max_rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = self.clock()
+                # Allow bursts of up to a second's worth of requests.
+                self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def slot(self, url):
+        host = urlparse.urlparse(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self.semaphores[host]
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.max_rate / 64, self.rate / 2)
+
+    def backoff(self, attempt, response=None):
+        # Full jitter, so that retrying threads don't all come back at
+        # once.
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if response is not None:
+            delay = max(delay, get_retry_after(response, self.clock()))
+        return delay
+
+def get_retry_after(response, now):
+    # Retry-After is either a number of seconds or an HTTP date.
+    value = response.headers.get('Retry-After')
+    if not value:
+        return 0
+    try:
+        return max(0, int(value))
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return 0
+        return max(0, email.utils.mktime_tz(date) - now)
+
+class ScheduledAdapter(requests.adapters.BaseAdapter):
+    """Sends requests through another adapter under a RequestScheduler.
+
+    Only requests that actually go out are scheduled, since cache hits
+    never get to the adapter. Streamed requests don't take a slot
+    here, since the body is read after send() returns; callers hold
+    scheduler.slot(url) around those themselves.
+    """
+
+    def __init__(self, scheduler, adapter):
+        super(ScheduledAdapter, self).__init__()
+        self.scheduler = scheduler
+        self.adapter = adapter
+
+    def send(self, request, **kwargs):
+        attempt = 0
+        while True:
+            self.scheduler.wait_for_token()
+            response = None
+            try:
+                if kwargs.get('stream'):
+                    response = self.adapter.send(request, **kwargs)
+                else:
+                    with self.scheduler.slot(request.url):
+                        response = self.adapter.send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= self.scheduler.max_retries:
+                    raise
+                error = e
+            else:
+                status = response.status_code
+                if status != 429 and status < 500:
+                    self.scheduler.succeeded()
+                    return response
+                if attempt >= self.scheduler.max_retries:
+                    return response
+                if status in (429, 503):
+                    self.scheduler.throttled()
+                error = "HTTP %d" % status
+                response.close()
+
+            delay = self.scheduler.backoff(attempt, response)
+            log_error("Got %s for %s %s, sleeping for %.1f seconds and retrying (attempt %d)" % (error, request.method, request.url, delay, attempt+1))
+            self.scheduler.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        self.adapter.close()
+
+class KeepAliveAdapter(requests.adapters.HTTPAdapter):
+    """An HTTPAdapter that turns on TCP keep-alive for its connections.
+
+    Otherwise a NAT or proxy may silently drop a pooled connection
+    that sat idle, e.g. while a big PDF was downloaded on another.
+    """
+
+    socket_options = requests.packages.urllib3.connection.HTTPConnection.default_socket_options + [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = self.socket_options
+        super(KeepAliveAdapter, self).init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        # Proxy pools, including SOCKS ones, don't get the pool
+        # manager's options.
+        proxy_kwargs['socket_options'] = self.socket_options
+        return super(KeepAliveAdapter, self).proxy_manager_for(proxy, **proxy_kwargs)
+
+def fetch_part(download_session, scheduler, chunk_size, url, part_path, offset, etag):
+    # Ask for the rest of the file only. If-Range makes the server
+    # send the whole file instead if it changed since the HEAD.
+    headers = {}
+    if offset > 0:
+        headers['Range'] = 'bytes=%d-' % offset
+        if etag:
+            headers['If-Range'] = etag
+
+    # The body is streamed, so hold the host's slot until it's all read.
+    with scheduler.slot(url):
+        r = download_session.get(url, headers=headers, stream=True)
+        r.raise_for_status()
+        md5 = hashlib.md5()
+        if r.status_code == 206:
+            mode = 'ab'
+            # Hash what's already there, so the MD5 covers the whole file.
+            update_md5_from_file(md5, part_path)
+        else:
+            # The server ignored the range, so rewrite from the start.
+            mode = 'wb'
+        with open(part_path, mode) as fd, metrics.timer('download_transfer'):
+            for chunk in r.iter_content(chunk_size):
+                md5.update(chunk)
+                fd.write(chunk)
+                metrics.count('bytes_downloaded', len(chunk))
+
+    return md5.hexdigest()
+
+def download_file(crawl_session, download_session, scheduler, manifest, dry, check_md5, chunk_size, doi, url, path, prefix=''):
+    if manifest.lookup_file(path, check_md5) is not None:
+        log("%sSkipping \"%s\", already verified" % (prefix, path))
+        metrics.count('files_skipped')
+        return
+
     # Always get response for now, to prime the cache.
     response = head_url(crawl_session, url)
     if os.path.exists(path):
         (expected, actual) = compare_file_with_headers(path, response.headers, check_md5)
         if expected == actual:
             if check_md5:
-                print "Skipping \"%s\", already exists (sizes and md5s match)" % (path)
+                log("%sSkipping \"%s\", already exists (sizes and md5s match)" % (prefix, path))
+                manifest.add_file(doi, path, actual[1], response.headers.get('ETag'))
             else:
-                print "Skipping \"%s\", already exists (sizes match)" % (path)
+                log("%sSkipping \"%s\", already exists (sizes match)" % (prefix, path))
+                manifest.add_file(doi, path, None, response.headers.get('ETag'))
+            metrics.count('files_skipped')
             return
         else:
-            print "File exists, but doesn't match headers: expected %s, got %s" % (expected, actual)
+            log("%sFile exists, but doesn't match headers: expected %s, got %s" % (prefix, expected, actual))
 
     maxAttempts = 3
-    delay = 3
 
-    print "Getting \"%s\" from %s" % (path, url)
+    log("%sGetting \"%s\" from %s" % (prefix, path, url))
     if not dry:
         (dirname, filename) = os.path.split(path)
         if dirname and not os.path.exists(dirname):
-            os.makedirs(dirname)
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Another worker may have just created it.
+                if not os.path.isdir(dirname):
+                    raise
+
+        # Download into a .part file next to path, which is only
+        # renamed into place once it matches the headers. An
+        # interrupted download is picked up where it left off, on
+        # the next attempt or the next run.
+        part_path = path + '.part'
+        expected_size = int(response.headers['Content-Length'])
+        can_resume = response.headers.get('Accept-Ranges', '').strip() == 'bytes'
 
         for i in xrange(0, maxAttempts):
-            r = download_session.get(url)
-            with open(path, 'wb') as fd:
-                for chunk in r.iter_content(512 * 1024):
-                    fd.write(chunk)
+            offset = 0
+            if os.path.exists(part_path):
+                offset = os.path.getsize(part_path)
 
-            (expected, actual) = compare_file_with_headers(path, response.headers, True)
+            md5 = None
+            if offset < expected_size:
+                try:
+                    md5 = fetch_part(download_session, scheduler, chunk_size, url, part_path, offset if can_resume else 0, response.headers.get('ETag'))
+                except requests.exceptions.RequestException as e:
+                    # Whatever was written so far is kept for the next attempt.
+                    delay = scheduler.backoff(i)
+                    log_error("Error downloading %s: %s, sleeping for %.1f seconds and retrying (attempt %d)" % (path, e, delay, i+1))
+                    scheduler.sleep(delay)
+                    continue
+
+            (expected, actual) = compare_file_with_headers(part_path, response.headers, True, md5)
             if expected == actual:
+                # Atomic on POSIX, so path is never a partial file.
+                os.rename(part_path, path)
+                manifest.add_file(doi, path, actual[1], response.headers.get('ETag'))
+                metrics.count('files_downloaded')
                 break
 
+            if os.path.getsize(part_path) >= expected_size:
+                # Complete but wrong, so start over instead of resuming.
+                os.remove(part_path)
+
             # When the above test fails, it's usually because of a
             # different MD5. But the etag MD5 is the erroneous one --
             # trying again (with a brand-new invocation of the script)
             # gets the correct one!
-            print "Downloaded file %s didn't match headers (expected %s, got %s), sleeping for %d seconds and retrying (attempt %d)" % (path, expected, actual, delay, i+1)
-            time.sleep(delay)
+            delay = scheduler.backoff(i)
+            log_error("Downloaded file %s didn't match headers (expected %s, got %s), sleeping for %.1f seconds and retrying (attempt %d)" % (path, expected, actual, delay, i+1))
+            scheduler.sleep(delay)
         else:
             # Failed all attempts.
             raise Exception("Downloaded file %s didn't match headers after %d attempts" % (path, maxAttempts))
 
-def download(crawl_session, download_session, dry, check_md5, raw_title, year, raw_authors, doi, url, index, count):
-    full_title = build_full_title(raw_title, year, raw_authors, doi)
-    filename = build_filename(raw_title, year, raw_authors, doi)
+def build_section_paths(full_title, sections):
+    paths = []
+    i = 1
+    for (raw_title, url, doi) in sections:
+        title = cleanup_section_title(raw_title, doi)
+        if doi:
+            doi_suffix = get_doi_suffix(doi)
+            filename = "%d - %s (%s).pdf" % (i, title, doi_suffix)
+        else:
+            filename = "%d - %s.pdf" % (i, title)
+        paths.append(os.path.join(full_title, filename))
+        i += 1
+    return paths
+
+def forget_book(crawl_session, doi, url):
+    # Drop the crawl cache's HEAD of the book's PDF and its landing
+    # page, which the TOC cache entry goes along with.
+    for (method, forget_url) in (('HEAD', build_pdf_url(doi)), ('GET', url)):
+        request = crawl_session.prepare_request(requests.Request(method, forget_url))
+        crawl_session.cache.delete(crawl_session.cache.create_key(request))
+
+def get_book_record(crawl_session, manifest, toc_cache, doi, url):
+    # Whether the book is available as a whole, or only as chapters,
+    # comes from the manifest if an earlier run already found out.
+    record = manifest.lookup_book(doi)
+    if record is not None:
+        return record
+
+    if manifest.get_book(doi) is not None:
+        # Checked too long ago, so ask Springer again rather than the
+        # crawl cache.
+        forget_book(crawl_session, doi, url)
 
+    # The manifest keeps this for good, so only a definite answer is
+    # recorded: a 200 means the whole book is available, and a 404
+    # that only the chapters are.
     pdf_url = build_pdf_url(doi)
+    response = head_url(crawl_session, pdf_url)
+    if response.status_code == 200:
+        manifest.add_book(doi, pdf_url, None)
+    elif response.status_code == 404:
+        sections = get_sections(crawl_session, toc_cache, doi, url)
+        manifest.add_book(doi, None, sections)
+    else:
+        raise Exception("Got HTTP %d for %s" % (response.status_code, pdf_url))
+    # Not lookup_book(), which with a --book-max-age of 0 would already
+    # find this record too old.
+    return manifest.get_book(doi)
+
+def plan_books(crawl_session, manifest, toc_cache, jobs, books):
+    """Yields a (book, book record) pair for each book, in order.
+
+    Books the manifest doesn't know about yet are probed on a separate
+    pool, along with fetching the sections of the ones that turn out
+    to be chapter-only. Probes run up to a few books per job ahead of
+    the book being yielded, so the caller rarely waits on a HEAD round
+    trip, and books can be streamed in without reading them all first.
+    """
+    probe_pool = WorkPool(jobs)
+    window = 4 * max(jobs, 1)
+    pending = collections.deque()
 
-    print "(%d/%d)" % (index+1, count),
+    def probe(book, done):
+        try:
+            get_book_record(crawl_session, manifest, toc_cache, book.doi, book.url)
+        finally:
+            done.set()
 
-    if url_exists(crawl_session, pdf_url):
-        download_file(crawl_session, download_session, dry, check_md5, pdf_url, filename)
+    def finish(book, done):
+        # Event.wait() can't be interrupted with Ctrl-C, so wait with a
+        # timeout instead. After another probe fails, the pool drops
+        # the calls still queued, so done may never be set; check()
+        # raises that failure instead.
+        while not done.wait(0.5):
+            probe_pool.check()
+        probe_pool.check()
+        # The age of the record only decides whether to probe.
+        return (book, manifest.get_book(book.doi))
+
+    for book in books:
+        done = threading.Event()
+        if manifest.lookup_book(book.doi) is None:
+            probe_pool.submit(probe, book, done)
+        else:
+            done.set()
+        pending.append((book, done))
+        while pending and (len(pending) > window or pending[0][1].is_set()):
+            yield finish(*pending.popleft())
+
+    while pending:
+        yield finish(*pending.popleft())
+
+def download(crawl_session, download_session, scheduler, manifest, pool, dry, check_md5, chunk_size, names, doi, record, index, count):
+    full_title = names.full_title
+    filename = names.filename
+
+    if count is None:
+        # Streaming in CSV order, so the total isn't known yet.
+        prefix = "(%d) " % (index+1)
     else:
-        sections = get_sections(crawl_session, url)
-        i = 1
-        link_strs = []
-        for (title, url, doi) in sections:
-            if doi:
-                doi_suffix = get_doi_suffix(doi)
-                filename = "%d - %s (%s).pdf" % (i, title, doi_suffix)
+        prefix = "(%d/%d) " % (index+1, count)
+
+    if record['pdf_url'] is not None:
+        download_file(crawl_session, download_session, scheduler, manifest, dry, check_md5, chunk_size, doi, record['pdf_url'], filename, prefix)
+        metrics.count('books_done')
+    else:
+        sections = record['sections']
+        paths = build_section_paths(full_title, sections)
+        if not sections:
+            metrics.count('books_done')
+
+        # The book is done when its last chapter is.
+        remaining = [len(sections)]
+        remaining_lock = threading.Lock()
+
+        def download_chapter(section_doi, url, path):
+            download_file(crawl_session, download_session, scheduler, manifest, dry, check_md5, chunk_size, section_doi, url, path, prefix)
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    metrics.count('books_done')
+
+        for ((title, url, section_doi), path) in zip(sections, paths):
+            # The per-chapter downloads go on the pool too, so a book
+            # with hundreds of chapters doesn't hold up the others.
+            pool.submit(download_chapter, section_doi, url, path)
+
+def build_book_files(names, record):
+    """Returns the (url, path) of each file of a book."""
+    if record['pdf_url'] is not None:
+        return [(record['pdf_url'], names.filename)]
+    full_title = names.full_title
+    sections = record['sections']
+    paths = build_section_paths(full_title, sections)
+    return [(url, path) for ((title, url, section_doi), path) in zip(sections, paths)]
+
+def get_expected_file(crawl_session, manifest, url, path):
+    """Returns the (size, md5) path should have, or (size, None) if
+    the MD5 isn't known.
+
+    The manifest is used if it has a record of the file, which is
+    trusted even if the file has changed since; otherwise the HEAD
+    response, usually from the crawl cache.
+    """
+    record = manifest.get_file(path)
+    if record is not None:
+        md5 = record['md5']
+        if md5 is None and record['etag']:
+            md5 = get_etag_md5(record['etag'])
+        return (record['size'], md5)
+
+    response = head_url(crawl_session, url)
+    etag = response.headers.get('ETag')
+    return (int(response.headers['Content-Length']), get_etag_md5(etag) if etag else None)
+
+def hash_file(path):
+    # Runs in a worker process of verify_files().
+    return (path, compute_file_md5(path))
+
+def verify_files(files, jobs):
+    """Checks files, a list of (path, expected size, expected md5), and
+    prints the missing, truncated and corrupt ones.
+
+    Sizes are checked first, and the files of the right size are then
+    hashed on a pool of processes, so hashing isn't limited to one
+    core. Returns the number of files with problems.
+    """
+    counts = collections.Counter()
+    expected_md5s = {}
+    for (path, expected_size, expected_md5) in files:
+        if not os.path.exists(path):
+            log(u"Missing \"%s\"" % path)
+            counts['missing'] += 1
+            continue
+        size = os.path.getsize(path)
+        if size < expected_size:
+            log(u"Truncated \"%s\": expected %d bytes, got %d" % (path, expected_size, size))
+            counts['truncated'] += 1
+        elif size > expected_size:
+            log(u"Corrupt \"%s\": expected %d bytes, got %d" % (path, expected_size, size))
+            counts['corrupt'] += 1
+        elif expected_md5 is None:
+            counts['unhashed'] += 1
+        else:
+            expected_md5s[path] = expected_md5
+
+    process_pool = multiprocessing.Pool(jobs)
+    try:
+        for (path, md5) in process_pool.imap_unordered(hash_file, expected_md5s.keys()):
+            if md5 == expected_md5s[path]:
+                counts['ok'] += 1
             else:
-                filename = "%d - %s.pdf" % (i, title)
-            path = os.path.join(full_title, filename)
-            download_file(crawl_session, download_session, dry, check_md5, url, path)
-            i += 1
-    
+                log(u"Corrupt \"%s\": expected md5 %s, got %s" % (path, expected_md5s[path], md5))
+                counts['corrupt'] += 1
+        process_pool.close()
+    finally:
+        process_pool.terminate()
+        process_pool.join()
+
+    log("Checked %d files: %d ok, %d of the right size but with no md5 to check, %d missing, %d truncated, %d corrupt" % (
+        len(files), counts['ok'], counts['unhashed'], counts['missing'], counts['truncated'], counts['corrupt']))
+    return counts['missing'] + counts['truncated'] + counts['corrupt']
+
+# names are the book's BookNames, computed once here and passed along
+# from there, since the title is also the sort key.
+Book = collections.namedtuple('Book', ['raw_title', 'year', 'raw_authors', 'doi', 'url', 'names'])
+
+def iter_books(csvpaths):
+    dois = set()
+    for csvpath in csvpaths:
+        with open(csvpath, 'rb') as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                raw_title = row['Item Title']
+                year = row['Publication Year']
+                raw_authors = row['Authors']
+                doi = row['Item DOI']
+                url = row['URL']
+
+                # Uniquify by DOI.
+                if doi in dois:
+                    continue
+                dois.add(doi)
+
+                names = build_book_names(raw_title, year, raw_authors, doi)
+                yield Book(raw_title, year, raw_authors, doi, url, names)
+
+def parse_shard(shard):
+    # "K/N", with K from 1 to N.
+    match = re.match(r'^(\d+)/(\d+)$', shard)
+    if match is None:
+        return None
+    (k, n) = (int(match.group(1)), int(match.group(2)))
+    if not 1 <= k <= n:
+        return None
+    return (k, n)
+
+def in_shard(doi, shard):
+    # Hash the DOI rather than use the book's position, so a book stays
+    # in the same shard however the csv files are split or ordered.
+    (k, n) = shard
+    return int(hashlib.md5(doi).hexdigest(), 16) % n == k - 1
+
+def build_shard_manifest_path(path, shard):
+    (root, ext) = os.path.splitext(path)
+    return "%s-shard-%d-of-%d%s" % (root, shard[0], shard[1], ext)
+
+def merge_manifests(path, shard_count):
+    # Later records override earlier ones, so the shard manifests can
+    # simply be replayed into the combined one.
+    manifest = Manifest(path)
+    for k in xrange(1, shard_count + 1):
+        shard_path = build_shard_manifest_path(path, (k, shard_count))
+        if not os.path.exists(shard_path):
+            raise Exception("Missing shard manifest %s" % shard_path)
+        print >> sys.stderr, "Merging %s into %s" % (shard_path, path)
+        for record in read_json_lines(shard_path):
+            manifest.write(record)
+    return manifest
+
 def main():
     UTF8Writer = codecs.getwriter('utf8')
     sys.stdout = UTF8Writer(sys.stdout)
@@ -368,73 +1486,208 @@ def main():
     parser.add_argument('csvpaths', metavar='/path/to/search-results.csv', nargs='+', help='the csv file with search results')
     parser.add_argument('--rename', help='look for existing files and rename them', action='store_true')
     parser.add_argument('--list', help='build a markdown list of the titles and links', action='store_true')
+    parser.add_argument('--list-out', metavar='PATH', help='with --list, write the list to this file instead of printing it')
+    parser.add_argument('--list-diff', help='with --list-out, print how the list changed since it was last written', action='store_true')
+    parser.add_argument('--book-max-age', metavar='DAYS', help="check again whether books are available as a whole or only as chapters if that was last checked more than this many days ago (default: never)",
+                        type=float)
     parser.add_argument('--dry', help="don't actually download any PDFs", action='store_true')
     parser.add_argument('--check-md5', help="check the MD5s of existing PDFs", action='store_true')
+    parser.add_argument('--verify-only', help="don't download anything, but report missing, truncated and corrupt files, checking sizes and md5s against the manifest or the crawl cache", action='store_true')
+    parser.add_argument('--verify-jobs', help='number of processes hashing files for --verify-only',
+                        type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--overrides', metavar='PATH', help="JSON file with more clean_titles, too_many_authors or clean_section_titles entries, like get-springer-books-data.json, to use on top of it (can be given more than once)",
+                        action='append', default=[])
+    parser.add_argument('--csv-order', help="process books in the order they appear in the csv files, as they are read, instead of sorting them by title first", action='store_true')
     parser.add_argument('--socks5', help='SOCKS5 proxy to use (host:port)')
+    parser.add_argument('--pool-size', help='number of connections to keep open to each host (default: the larger of --jobs, --probe-jobs and 10)',
+                        type=int)
+    parser.add_argument('--no-keep-alive', help="close connections after each request instead of reusing them", action='store_true')
+    parser.add_argument('--chunk-size', metavar='KB', help='size of the blocks downloads are read and written in, in KB',
+                        type=int, default=1024)
+    parser.add_argument('--http2', help='use HTTP/2 for https URLs (needs hyper)', action='store_true')
     parser.add_argument('--crawl-cache', help='Location of crawl cache',
                         default='/tmp/get-springer-books-crawl-cache')
+    parser.add_argument('--crawl-cache-backend', help='how to store the crawl cache: sqlite (the default), memory (not kept between runs) or compressed (zlib-compressed sqlite)',
+                        choices=('sqlite', 'memory', 'compressed'), default='sqlite')
+    parser.add_argument('--crawl-cache-size', help='maximum number of responses in the crawl cache, dropping the oldest beyond that (0 for no limit)',
+                        type=int, default=0)
+    parser.add_argument('--crawl-cache-ttl', help='number of days crawl cache entries stay fresh (default: forever)',
+                        type=float)
+    parser.add_argument('--crawl-cache-404-ttl', help='number of days cached 404s stay fresh (default: forever)',
+                        type=float)
+    parser.add_argument('--crawl-cache-redirect-ttl', help='number of days cached redirects stay fresh (default: forever)',
+                        type=float)
+    parser.add_argument('--crawl-cache-stats', help='print crawl cache hits and misses at the end', action='store_true')
+    parser.add_argument('--jobs', help='number of books and chapters to download concurrently',
+                        type=int, default=1)
+    parser.add_argument('--probe-jobs', help='number of books to check the availability of concurrently before downloading or listing',
+                        type=int, default=8)
+    parser.add_argument('--per-host', help='maximum number of concurrent requests to a single host',
+                        type=int, default=4)
+    parser.add_argument('--rate', help='maximum number of requests per second (0 for no limit); lowered automatically while the server throttles us',
+                        type=float, default=10)
+    parser.add_argument('--max-retries', help='number of times to retry a request that failed or was throttled',
+                        type=int, default=5)
+    parser.add_argument('--metrics-out', help='write timings and counters for the run to this file, as JSON or, if it ends in .prom, in the Prometheus textfile format')
+    parser.add_argument('--progress', help='show books done, throughput and ETA on stderr', action='store_true')
+    parser.add_argument('--manifest', help="Location of the manifest of verified files (empty to not keep one)",
+                        default='.get-springer-books-manifest.jsonl')
+    parser.add_argument('--shard', help="only handle the Kth of N shards of the books (K/N, e.g. 2/4), split by DOI, keeping a separate manifest for the shard")
+    parser.add_argument('--merge-manifests', metavar='N', help="first merge the manifests of shards 1/N to N/N into --manifest, e.g. before --list",
+                        type=int)
     args = parser.parse_args()
 
-    if args.socks5:
-        import socket
-        import socks
-        (host, port) = args.socks5.split(':')
-        socks.set_default_proxy(socks.SOCKS5, host, int(port))
-        socket.socket = socks.socksocket
+    metrics.reset()
 
-        print "Using crawl cache at %s" % (args.crawl_cache)
+    if args.overrides:
+        set_cleanup_tables(load_cleanup_tables([data_path] + args.overrides))
+
+    shard = None
+    if args.shard is not None:
+        shard = parse_shard(args.shard)
+        if shard is None:
+            parser.error("--shard must be K/N with 1 <= K <= N")
+        if args.merge_manifests is not None:
+            parser.error("--shard can't be used with --merge-manifests")
+        if args.manifest:
+            args.manifest = build_shard_manifest_path(args.manifest, shard)
+    if args.merge_manifests is not None and not args.manifest:
+        parser.error("--merge-manifests needs a --manifest to merge into")
+    if args.list_out and not args.list:
+        parser.error("--list-out needs --list")
+    if args.list_diff and not args.list_out:
+        parser.error("--list-diff needs --list-out")
+
+    if args.http2:
+        try:
+            import hyper.contrib
+        except ImportError:
+            parser.error("--http2 needs hyper (pip install hyper)")
+        if args.socks5:
+            parser.error("--http2 can't be used with --socks5")
+
+    def days_to_seconds(days):
+        if days is None:
+            return None
+        return days * 24 * 60 * 60
+
+    ttls = {
+        'ok': days_to_seconds(args.crawl_cache_ttl),
+        'not_found': days_to_seconds(args.crawl_cache_404_ttl),
+        'redirect': days_to_seconds(args.crawl_cache_redirect_ttl),
+    }
+    crawl_cache = build_crawl_cache(args.crawl_cache_backend, args.crawl_cache, args.crawl_cache_size, ttls)
 
-    # Caches redirects, and also 404s so we cache url_exists queries.
-    crawl_session = requests_cache.core.CachedSession(args.crawl_cache, allowable_methods=('GET', 'HEAD'), allowable_codes=(200,301,302,404))
+    # Caches redirects, and also 404s so we cache the probes for whole
+    # book PDFs.
+    crawl_session = requests_cache.core.CachedSession(args.crawl_cache, backend=crawl_cache, allowable_methods=('GET', 'HEAD'), allowable_codes=(200,301,302,404))
     download_session = requests.session()
+
+    # The default pool keeps only 10 connections per host, which would
+    # throw away connections with more jobs than that.
+    pool_size = args.pool_size
+    if pool_size is None:
+        pool_size = max(args.jobs, args.probe_jobs, 10)
+    # Both sessions share one scheduler, so its limits apply to all
+    # requests to a host.
+    scheduler = RequestScheduler(args.rate, args.per_host, args.max_retries)
+    for session in (crawl_session, download_session):
+        adapter = ScheduledAdapter(scheduler, KeepAliveAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        session.mount('http://', adapter)
+        if args.http2:
+            session.mount('https://', ScheduledAdapter(scheduler, hyper.contrib.HTTP20Adapter()))
+        else:
+            session.mount('https://', adapter)
+        if args.no_keep_alive:
+            session.headers['Connection'] = 'close'
+        if args.socks5:
+            # socks5h resolves host names through the proxy too. This
+            # needs requests' SOCKS support (pip install requests[socks]).
+            proxy = 'socks5h://%s' % args.socks5
+            session.proxies = {'http': proxy, 'https': proxy}
+            # Otherwise http_proxy and friends would take precedence.
+            session.trust_env = False
+
+    if args.socks5:
+        print "Using crawl cache at %s" % (args.crawl_cache)
+
+    pool = WorkPool(args.jobs)
+    if args.merge_manifests is not None:
+        manifest = merge_manifests(args.manifest, args.merge_manifests)
+    else:
+        manifest = Manifest(args.manifest)
+    if args.book_max_age is not None:
+        manifest.max_book_age = days_to_seconds(args.book_max_age)
+    toc_cache = TocCache(args.crawl_cache + '-toc.jsonl')
     
-    books = []
-    dois = set()
-    for csvpath in args.csvpaths:
-        with open(csvpath, 'rb') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                raw_title = row['Item Title']
-                year = row['Publication Year']
-                raw_authors = row['Authors']
-                doi = row['Item DOI']
-                url = row['URL']
+    books = iter_books(args.csvpaths)
+    if shard is not None:
+        books = (book for book in books if in_shard(book.doi, shard))
+    count = None
+    if not args.csv_order:
+        books = sorted(books, key=lambda book: (book.names.title, book.year))
+        count = len(books)
 
-                # Uniquify by DOI.
-                if doi in dois:
-                    continue
-                dois.add(doi)
+    if args.rename:
+        index = FileIndex(u'.')
+        for book in books:
+            rename(index, manifest, book.names, book.doi, book.url)
+        return
 
-                book = {
-                    'raw_title': raw_title,
-                    'year': year,
-                    'raw_authors': raw_authors,
-                    'doi': doi,
-                    'url': url,
-                }
-                books.append(book)
+    plan = plan_books(crawl_session, manifest, toc_cache, args.probe_jobs, books)
 
-    def sort_key(book):
-        title = cleanup_title(book['raw_title'], book['doi'])
-        year = book['year']
-        return (title, year)
+    if args.verify_only:
+        files = []
+        files_lock = threading.Lock()
 
-    sorted_books = sorted(books, key=sort_key)
+        def add_expected_file(url, path):
+            expected = get_expected_file(crawl_session, manifest, url, path)
+            with files_lock:
+                files.append((path,) + expected)
 
+        probe_pool = WorkPool(args.probe_jobs)
+        for (book, record) in plan:
+            for (url, path) in build_book_files(book.names, record):
+                probe_pool.submit(add_expected_file, url, path)
+        probe_pool.join()
+
+        files.sort()
+        if verify_files(files, args.verify_jobs) > 0:
+            sys.exit(1)
+        return
+
+    global progress
+    if args.progress:
+        progress = Progress(count, 1 if sys.stderr.isatty() else 30)
+        progress.start()
+
+    list_entries = []
     i = 0
-    for book in sorted_books:
-        raw_title = book['raw_title']
-        year = book['year']
-        raw_authors = book['raw_authors']
-        doi = book['doi']
-        url = book['url']
-        if args.rename:
-            rename(raw_title, year, raw_authors, doi, url)
+    for (book, record) in plan:
+        if args.list_out:
+            list_entries.append(build_list_entry(book.names, record))
+            metrics.count('books_done')
         elif args.list:
-            list_files(crawl_session, raw_title, year, raw_authors, doi, url)
+            list_files(book.names, record)
+            metrics.count('books_done')
         else:
-            download(crawl_session, download_session, args.dry, args.check_md5, raw_title, year, raw_authors, doi, url, i, len(sorted_books))
+            pool.submit(download, crawl_session, download_session, scheduler, manifest, pool, args.dry, args.check_md5, args.chunk_size * 1024, book.names, book.doi, record, i, count)
         i += 1
 
+    pool.join()
+
+    if args.list_out:
+        write_list(args.list_out, list_entries, args.list_diff)
+
+    if progress is not None:
+        progress.stop()
+        progress = None
+
+    if args.crawl_cache_stats:
+        print >> sys.stderr, crawl_cache.get_stats()
+
+    if args.metrics_out:
+        metrics.write_report(args.metrics_out, crawl_cache)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+# Checks the request scheduler's retry and throttling behavior and the
+# crawl cache's handling of redirects, including re-probing books with
+# --book-max-age, against local stub servers. Run with
+#
+#   python2.7 test-get-springer-books.py
+
+import BaseHTTPServer
+import csv
+import imp
+import os
+import shutil
+import SocketServer
+import StringIO
+import sys
+import tempfile
+import threading
+import unittest
+
+import requests
+
+script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'get-springer-books.py')
+gsb = imp.load_source('get_springer_books', script_path)
+
+class ScriptedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers each request with the next of the server's responses."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(self.path)
+            (status, headers) = self.server.responses.pop(0)
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+class ScriptedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, responses):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), ScriptedHandler)
+        self.lock = threading.Lock()
+        self.responses = list(responses)
+        self.requests = []
+
+class RedirectingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Redirects PDF URLs to /secure/..., like Springer's move from
+    http to https, and answers those with a small PDF."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        with self.server.lock:
+            self.server.requests.append(self.path)
+        if self.path.startswith('/content/pdf/'):
+            self.send_response(301)
+            self.send_header('Location', 'http://%s:%d/secure%s' % (self.server.server_address + (self.path,)))
+        else:
+            self.send_response(200)
+            self.send_header('ETag', '"0123456789abcdef0123456789abcdef"')
+            self.send_header('Content-Length', '10')
+        self.end_headers()
+
+class RedirectingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), RedirectingHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+
+def start_server(test, server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    return server
+
+def make_tmpdir(test):
+    tmpdir = tempfile.mkdtemp(prefix='test-get-springer-books-')
+    test.addCleanup(shutil.rmtree, tmpdir)
+    return tmpdir
+
+class FakeTime(object):
+    """A clock that only moves when slept on, remembering each sleep
+    along with the scheduler's rate at the time."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+        self.scheduler = None
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append((seconds, self.scheduler.rate))
+        self.now += seconds
+
+class SchedulerTest(unittest.TestCase):
+
+    def start_server(self, responses):
+        return start_server(self, ScriptedServer(responses))
+
+    def build_session(self, max_retries):
+        fake_time = FakeTime()
+        # No jitter, so the delays are exactly what Retry-After asks for.
+        scheduler = gsb.RequestScheduler(10, 4, max_retries, base_delay=0, clock=fake_time.clock, sleep=fake_time.sleep)
+        fake_time.scheduler = scheduler
+        session = requests.session()
+        session.trust_env = False
+        session.mount('http://', gsb.ScheduledAdapter(scheduler, requests.adapters.HTTPAdapter()))
+        return (session, scheduler, fake_time)
+
+    def test_retries_after_429(self):
+        server = self.start_server([(429, {'Retry-After': '3'}), (200, {})])
+        (session, scheduler, fake_time) = self.build_session(5)
+
+        response = session.get('http://127.0.0.1:%d/content/pdf/x.pdf' % server.server_address[1])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(server.requests), 2)
+        # One sleep, for as long as Retry-After asked, at half the rate.
+        self.assertEqual(fake_time.sleeps, [(3, 5.0)])
+        # The success afterwards raises the rate again by a 20th.
+        self.assertEqual(scheduler.rate, 5.5)
+
+    def test_gives_up_after_max_retries(self):
+        server = self.start_server([(503, {'Retry-After': '1'})] * 3)
+        (session, scheduler, fake_time) = self.build_session(2)
+
+        response = session.get('http://127.0.0.1:%d/content/pdf/x.pdf' % server.server_address[1])
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual([seconds for (seconds, rate) in fake_time.sleeps], [1, 1])
+        self.assertEqual(scheduler.rate, 2.5)
+
+class CrawlCacheTest(unittest.TestCase):
+
+    def build_session(self, redirect_ttl):
+        ttls = {'ok': None, 'not_found': None, 'redirect': redirect_ttl}
+        crawl_cache = gsb.build_crawl_cache('sqlite', os.path.join(make_tmpdir(self), 'cc'), 0, ttls)
+        session = gsb.requests_cache.core.CachedSession('cc', backend=crawl_cache, allowable_methods=('GET', 'HEAD'), allowable_codes=(200, 301, 302, 404))
+        session.trust_env = False
+        return session
+
+    def test_delete_redirected(self):
+        server = start_server(self, RedirectingServer())
+        session = self.build_session(None)
+        url = 'http://127.0.0.1:%d/content/pdf/x.pdf' % server.server_address[1]
+
+        self.assertEqual(gsb.head_url(session, url).status_code, 200)
+        request = session.prepare_request(requests.Request('HEAD', url))
+        session.cache.delete(session.cache.create_key(request))
+
+        # Saving the response again needs the other tables unlocked.
+        # The /secure hop is cached under its own key, so only the
+        # redirect is asked for again.
+        self.assertEqual(gsb.head_url(session, url).status_code, 200)
+        self.assertEqual(gsb.head_url(session, url).status_code, 200)
+        self.assertEqual(server.requests, ['/content/pdf/x.pdf', '/secure/content/pdf/x.pdf', '/content/pdf/x.pdf'])
+
+    def test_expire_redirected(self):
+        server = start_server(self, RedirectingServer())
+        session = self.build_session(0)
+        url = 'http://127.0.0.1:%d/content/pdf/x.pdf' % server.server_address[1]
+
+        # Every lookup finds the redirected response expired, and
+        # deletes it before fetching it again.
+        for i in xrange(3):
+            self.assertEqual(gsb.head_url(session, url).status_code, 200)
+        self.assertEqual(server.requests.count('/content/pdf/x.pdf'), 3)
+
+class BookMaxAgeTest(unittest.TestCase):
+
+    def setUp(self):
+        # Go straight to the stub server.
+        for name in ('http_proxy', 'HTTP_PROXY', 'https_proxy', 'HTTPS_PROXY'):
+            if name in os.environ:
+                self.addCleanup(os.environ.__setitem__, name, os.environ.pop(name))
+
+    def run_main(self, args):
+        # Returns what main() printed.
+        old_argv = sys.argv
+        old_stdout = sys.stdout
+        output = StringIO.StringIO()
+        sys.argv = [script_path] + args
+        sys.stdout = output
+        try:
+            gsb.main()
+        finally:
+            sys.stdout = old_stdout
+            sys.argv = old_argv
+        return output.getvalue()
+
+    def test_reprobe_redirected_pdf(self):
+        server = start_server(self, RedirectingServer())
+        old_springer_url = gsb.springer_url
+        self.addCleanup(setattr, gsb, 'springer_url', old_springer_url)
+        gsb.springer_url = 'http://127.0.0.1:%d' % server.server_address[1]
+
+        tmpdir = make_tmpdir(self)
+        csv_path = os.path.join(tmpdir, 'SearchResults.csv')
+        with open(csv_path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Item Title', 'Publication Year', 'Authors', 'Item DOI', 'URL'])
+            writer.writerow(['A Book', '1999', 'Jane Doe', '10.1007/978-0-0000', gsb.springer_url + '/book/10.1007/978-0-0000'])
+        args = [csv_path, '--list', '--rate', '0', '--crawl-cache', os.path.join(tmpdir, 'cc'), '--manifest', os.path.join(tmpdir, 'manifest.jsonl')]
+
+        first = self.run_main(args)
+        # The HEAD through the 301 is dropped from the sqlite crawl
+        # cache before the book is probed again.
+        second = self.run_main(args + ['--book-max-age', '0'])
+
+        self.assertEqual(first, u'[A Book - Jane Doe (1999) (978-0-0000)](%s/content/pdf/10.1007/978-0-0000.pdf)\n\n' % gsb.springer_url)
+        self.assertEqual(second, first)
+        self.assertEqual(server.requests.count('/content/pdf/10.1007/978-0-0000.pdf'), 2)
+
+if __name__ == '__main__':
+    unittest.main()